@@ -1,10 +1,29 @@
 """Cluster Environment"""
+import functools
+
 import numpy as np
 
 from hlo import ShardingSpec, ShardingSpecType
 from common import compute_bytes, get_dim_last_value
 
 
+# The cost of a collective only depends on these scalars, and the solver queries
+# the same few tensor sizes over and over, so memoize them.
+@functools.lru_cache(maxsize=None)
+def _all_gather_cost(alpha, beta, num_devices, num_bytes):
+    return int(alpha + beta * (num_devices - 1) / num_devices * num_bytes) + 0.1
+
+
+@functools.lru_cache(maxsize=None)
+def _all_reduce_cost(alpha, beta, num_devices, num_bytes):
+    return int(alpha + beta * 2 * (num_devices - 1) / num_devices * num_bytes) + 0.01
+
+
+@functools.lru_cache(maxsize=None)
+def _reduce_scatter_cost(alpha, beta, num_devices, num_bytes):
+    return int(alpha + beta * (num_devices - 1) / num_devices * num_bytes) + 0.001
+
+
 class ClusterEnvironment:
     def __init__(self, device_mesh, mesh_alpha, mesh_beta, memory_per_device, solver_option=None):
         self.device_mesh = np.array(device_mesh)
@@ -18,6 +37,11 @@ class ClusterEnvironment:
         self.reduce_scatter_penalty = 0
         self.partial_reduction_penalty = 10
         self.num_devices = np.prod(self.device_mesh.shape)
+        # The last device id along each mesh dimension
+        self.mesh_dim_vals = tuple(get_dim_last_value(self.device_mesh, j)
+            for j in range(len(self.device_mesh.shape)))
+        # Map (tensor rank, sharding spec) to the result of get_tensor_dim_to_mesh_dim
+        self.tensor_dim_to_mesh_dim_cache = {}
 
         self.force_all_gather_cost = None
         self.force_all_reduce_cost = None
@@ -32,28 +56,24 @@ class ClusterEnvironment:
         if self.force_all_gather_cost:
             return self.force_all_gather_cost
 
-        num_devices = self.device_mesh.shape[mesh_dim]
-        return (int(self.mesh_alpha[mesh_dim] +
-                self.mesh_beta[mesh_dim] * (num_devices - 1) / num_devices * num_bytes) +
-                0.1) + self.all_gather_penalty
+        return _all_gather_cost(self.mesh_alpha[mesh_dim], self.mesh_beta[mesh_dim],
+                                self.device_mesh.shape[mesh_dim], num_bytes) +\
+            self.all_gather_penalty
 
     def all_reduce_cost(self, num_bytes, mesh_dim=0):
         if self.force_all_reduce_cost:
             return self.force_all_reduce_cost
 
-        num_devices = self.device_mesh.shape[mesh_dim]
-        return (int(self.mesh_alpha[mesh_dim] +
-                self.mesh_beta[mesh_dim] * 2 * (num_devices - 1) / num_devices * num_bytes) +
-                0.01) + self.all_reduce_penalty
+        return _all_reduce_cost(self.mesh_alpha[mesh_dim], self.mesh_beta[mesh_dim],
+                                self.device_mesh.shape[mesh_dim], num_bytes) +\
+            self.all_reduce_penalty
 
     def reduce_scatter_cost(self, num_bytes, mesh_dim=0):
         if self.force_reduce_scatter_cost:
             return self.force_reduce_scatter_cost
 
-        num_devices = self.device_mesh.shape[mesh_dim]
-        return (int(self.mesh_alpha[mesh_dim] +
-                self.mesh_beta[mesh_dim] * (num_devices - 1) / num_devices * num_bytes) +
-                0.001)
+        return _reduce_scatter_cost(self.mesh_alpha[mesh_dim], self.mesh_beta[mesh_dim],
+                                    self.device_mesh.shape[mesh_dim], num_bytes)
 
     def all_to_all_cost(self, num_bytes, mesh_dim=0):
         num_devices = self.device_mesh.shape[mesh_dim]
@@ -65,8 +85,15 @@ class ClusterEnvironment:
 
     def get_tensor_dim_to_mesh_dim(self, shape, spec):
         """Map the tensor dimention to mesh dimension, -1 means replicated"""
+        key = (len(shape), spec)
+        ret = self.tensor_dim_to_mesh_dim_cache.get(key)
+        if ret is not None:
+            return ret
+
         if spec.type == ShardingSpecType.REPLICATED:
-            return [-1] * len(shape)
+            ret = (-1,) * len(shape)
+            self.tensor_dim_to_mesh_dim_cache[key] = ret
+            return ret
 
         tile_assignment = np.array(spec.tile_assignment_devices).\
             reshape(spec.tile_assignment_dimensions)
@@ -74,19 +101,18 @@ class ClusterEnvironment:
         tensor_dim_vals = tuple(get_dim_last_value(tile_assignment, i)
             for i in range(len(shape)))
 
-        mesh_dim_vals = tuple(get_dim_last_value(self.device_mesh, j)
-            for j in range(len(self.device_mesh.shape)))
-
         ret = [-1] * len(shape)
         for i in range(len(shape)):
             if spec.tile_assignment_dimensions[i] != 1:
                 found = False
                 for j in range(len(self.device_mesh.shape)):
-                    if tensor_dim_vals[i] == mesh_dim_vals[j]:
+                    if tensor_dim_vals[i] == self.mesh_dim_vals[j]:
                         ret[i] = j
                         found = True
                 assert found
 
+        ret = tuple(ret)
+        self.tensor_dim_to_mesh_dim_cache[key] = ret
         return ret
 
     def resharding_cost(self, shape, src_spec, dst_spec):
@@ -2,6 +2,7 @@
 
 from collections import defaultdict
 from enum import Enum, auto
+import functools
 
 import numpy as np
 
@@ -246,6 +247,10 @@ class ShardingSpec:
                 self.replicate_on_last_tile_dim == other.replicate_on_last_tile_dim and
                 self.partial_reduce_replication == other.partial_reduce_replication)
 
+    def __hash__(self):
+        return hash((self.type, self.tile_assignment_dimensions, self.tile_assignment_devices,
+                     self.replicate_on_last_tile_dim, self.partial_reduce_replication))
+
 
 def resharding_cost_vector(cluster_env, source_ins, required_spec):
     cost_vector = []
@@ -291,6 +296,10 @@ op_code_ct = defaultdict(int)
 
 
 class HloInstruction:
+    __slots__ = ('op_code', 'shape', 'operands', 'name',
+                 'strategies', 'compute_costs', 'communication_costs', 'memory_costs',
+                 'resharding_costs', 'follow_ins', 'depth', 'index', 'batch_dim')
+
     def __init__(self, op_code, shape, operands=[]):
         # Attributes
         self.op_code = op_code
@@ -320,6 +329,8 @@ class HloInstruction:
 
 
 class HloParameter(HloInstruction):
+    __slots__ = ('fix_strategy',)
+
     def __init__(self, shape, fix_strategy=None):
         super().__init__(OpCode.PARAMETER, shape, [])
         self.fix_strategy = fix_strategy
@@ -367,6 +378,8 @@ class HloParameter(HloInstruction):
 
 
 class HloConstant(HloInstruction):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         super().__init__(OpCode.CONSTANT, (), [])
         self.value = value
@@ -382,13 +395,27 @@ class HloConstant(HloInstruction):
 
 
 class HloBroadcast(HloInstruction):
+    __slots__ = ('dimensions', 'is_replicated_scalar')
+
     def __init__(self, operand, shape, dimensions=()):
         for i in dimensions:
             assert shape[i] == operand.shape[dimensions.index(i)]
         super().__init__(OpCode.BROADCAST, shape, [operand])
         self.dimensions = dimensions
+        # A broadcasted scalar constant is always replicated and free
+        self.is_replicated_scalar = (operand.op_code == OpCode.CONSTANT and
+                                     len(operand.shape) == 0)
 
     def build_strategy_and_cost(self, cluster_env, solver_option):
+        if self.is_replicated_scalar:
+            self.strategies.append(InstructionStrategy("R",
+                ShardingSpec.replicated(cluster_env)))
+            self.compute_costs.append(0)
+            self.communication_costs.append(0)
+            self.memory_costs.append(compute_bytes(self.shape))
+            self.resharding_costs.append([[0]])
+            return
+
         follow = self.operands[0]
         self.follow_ins = follow
 
@@ -407,6 +434,8 @@ class HloBroadcast(HloInstruction):
 
 
 class HloReshape(HloInstruction):
+    __slots__ = ('new_shape',)
+
     def __init__(self, operand, new_shape):
         # todo: mark this as inplace
         assert np.prod(operand.shape) == np.prod(new_shape)
@@ -437,6 +466,8 @@ class HloReshape(HloInstruction):
 
 
 class HloTranspose(HloInstruction):
+    __slots__ = ('dimensions',)
+
     def __init__(self, operand, dimensions):
         assert len(dimensions) == len(operand.shape)
         new_shape = tuple(operand.shape[i] for i in dimensions)
@@ -462,6 +493,8 @@ class HloTranspose(HloInstruction):
 
 
 class HloElementwise(HloInstruction):
+    __slots__ = ()
+
     def __init__(self, op_code, operands):
         for i in range(0, len(operands)):
             assert operands[0].shape == operands[i].shape
@@ -504,16 +537,22 @@ class HloElementwise(HloInstruction):
 
 
 class HloIdentity(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, operand):
         super().__init__(OpCode.IDENTITY, [operand])
 
 
 class HloExp(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, operand):
         super().__init__(OpCode.EXP, [operand])
 
 
 class HloForceReplicated(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, operand):
         super().__init__(OpCode.FORCE_REPLICATED, [operand])
 
@@ -530,36 +569,50 @@ class HloForceReplicated(HloElementwise):
 
 
 class HloAdd(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super().__init__(OpCode.ADD, [lhs, rhs])
 
 
 class HloSubtract(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super().__init__(OpCode.SUBTRACT, [lhs, rhs])
 
 
 class HloMutiply(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super().__init__(OpCode.MULTIPLY, [lhs, rhs])
 
 
 class HloDiv(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super().__init__(OpCode.DIV, [lhs, rhs])
 
 
 class HloCompare(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super().__init__(OpCode.COMPARE, [lhs, rhs])
 
 
 class HloSelect(HloElementwise):
+    __slots__ = ()
+
     def __init__(self, pred, true_value, false_value):
         super().__init__(OpCode.SELECT, [pred, true_value, false_value])
 
 
 class HloReduce(HloInstruction):
+    __slots__ = ('dimensions',)
+
     def __init__(self, operand, dimensions):
         new_shape = tuple(operand.shape[i] for i in range(len(operand.shape)) if i not in dimensions)
         super().__init__(OpCode.REDUCE, new_shape, [operand])
@@ -627,25 +680,39 @@ class HloReduce(HloInstruction):
                f"dimensions={self.dimensions}"
 
 
+@functools.lru_cache(maxsize=None)
+def dot_output_shape(lhs_shape, rhs_shape,
+                     lhs_batch_dims, lhs_contracting_dims,
+                     rhs_batch_dims, rhs_contracting_dims):
+    """Infer the output shape of a dot. Models only have a few distinct
+       dot shapes, so the results are memoized."""
+    lhs_space_shape = \
+        tuple(lhs_shape[i] for i in range(len(lhs_shape))
+              if i not in lhs_contracting_dims and i not in lhs_batch_dims)
+    rhs_space_shape = \
+        tuple(rhs_shape[i] for i in range(len(rhs_shape))
+              if i not in rhs_contracting_dims and i not in rhs_batch_dims)
+    lhs_batch_shape = tuple(lhs_shape[i] for i in lhs_batch_dims)
+
+    for i, j in zip(lhs_contracting_dims, rhs_contracting_dims):
+        assert lhs_shape[i] == rhs_shape[j]
+    for i, j in zip(lhs_batch_dims, rhs_batch_dims):
+        assert lhs_shape[i] == rhs_shape[j]
+
+    return lhs_batch_shape + lhs_space_shape + rhs_space_shape
+
+
 class HloDot(HloInstruction):
+    __slots__ = ('lhs', 'lhs_batch_dims', 'lhs_contracting_dims', 'lhs_space_dims',
+                 'rhs', 'rhs_batch_dims', 'rhs_contracting_dims', 'rhs_space_dims')
+
     def __init__(self, lhs, rhs,
                  lhs_batch_dims=(), lhs_contracting_dims=(1,),
                  rhs_batch_dims=(), rhs_contracting_dims=(0,)):
         # shape inference
-        lhs_space_shape = \
-            tuple(lhs.shape[i] for i in range(len(lhs.shape))
-                  if i not in lhs_contracting_dims and i not in lhs_batch_dims)
-        rhs_space_shape = \
-            tuple(rhs.shape[i] for i in range(len(rhs.shape))
-                  if i not in rhs_contracting_dims and i not in rhs_batch_dims)
-        lhs_batch_shape = tuple(lhs.shape[i] for i in lhs_batch_dims)
-
-        shape = lhs_batch_shape + lhs_space_shape + rhs_space_shape
-
-        for i, j in zip(lhs_contracting_dims, rhs_contracting_dims):
-            assert lhs.shape[i] == rhs.shape[j]
-        for i, j in zip(lhs_batch_dims, rhs_batch_dims):
-            assert lhs.shape[i] == rhs.shape[j]
+        shape = dot_output_shape(tuple(lhs.shape), tuple(rhs.shape),
+                                 tuple(lhs_batch_dims), tuple(lhs_contracting_dims),
+                                 tuple(rhs_batch_dims), tuple(rhs_contracting_dims))
 
         super().__init__(OpCode.DOT, shape, [lhs, rhs])
         self.lhs = lhs
@@ -828,6 +895,14 @@ class HloDot(HloInstruction):
             self.memory_costs = [self.memory_costs[i] for i in filter_indices]
             self.resharding_costs = [self.resharding_costs[i] for i in filter_indices]
 
+    def strategy_key(self):
+        """Dots with the same key get the same strategies and costs"""
+        return (tuple(self.shape), tuple(self.lhs.shape), tuple(self.rhs.shape),
+                tuple(self.lhs_batch_dims), tuple(self.lhs_contracting_dims),
+                tuple(self.rhs_batch_dims), tuple(self.rhs_contracting_dims), self.batch_dim,
+                tuple(x.output_spec for x in self.lhs.strategies),
+                tuple(x.output_spec for x in self.rhs.strategies))
+
     def propagate_batch_dim(self, operand):
         index = self.operands.index(operand)
 
@@ -859,6 +934,8 @@ class HloDot(HloInstruction):
 
 
 class HloTuple(HloInstruction):
+    __slots__ = ()
+
     def __init__(self, operands):
         super().__init__(OpCode.TUPLE, (), operands)
 
@@ -875,6 +952,16 @@ class HloTuple(HloInstruction):
         return f"{self.name} {self.shape} = tuple{names}"
 
 
+def _builder(ins_class):
+    """Make a HloComputation method that creates an `ins_class` instruction."""
+    def method(self, *args, **kwargs):
+        assert HloComputation.cur_env is self, \
+            f"{ins_class.__name__} must be built inside `with` of its computation"
+        return ins_class(*args, **kwargs)
+    method.__name__ = ins_class.__name__
+    return method
+
+
 class HloComputation:
     cur_env = None
 
@@ -882,10 +969,16 @@ class HloComputation:
         self.ct = 0
         self.instructions = []
         self.alias_list = []
+        self.alias_idx = np.empty((0, 2), dtype=np.int32)
         self.alias_cost_vector = []
 
         self.parameters = []
 
+        # Struct-of-arrays view of the instructions, built by freeze()
+        self.byte_sizes = None
+        self.operand_indptr = None
+        self.operand_indices = None
+
         self.strategy_built = False
 
     def append(self, instruction):
@@ -897,6 +990,21 @@ class HloComputation:
 
         return ct
 
+    def freeze(self):
+        """Pack the byte sizes and operands of all instructions into flat arrays.
+           The operands of instruction i are
+           operand_indices[operand_indptr[i]:operand_indptr[i+1]]."""
+        N = len(self.instructions)
+        self.byte_sizes = np.empty((N,), dtype=np.int64)
+        self.operand_indptr = np.empty((N + 1,), dtype=np.int32)
+        self.operand_indptr[0] = 0
+        operand_indices = []
+        for i, ins in enumerate(self.instructions):
+            self.byte_sizes[i] = compute_bytes(ins.shape)
+            operand_indices.extend(operand.index for operand in ins.operands)
+            self.operand_indptr[i + 1] = len(operand_indices)
+        self.operand_indices = np.array(operand_indices, dtype=np.int32)
+
     def liveness_analysis(self):
         liveness_dict = dict()
 
@@ -917,6 +1025,20 @@ class HloComputation:
 
     def set_alias(self, alias_list):
         self.alias_list = alias_list
+        # (N, 2) array of instruction indices of the alias pairs
+        self.alias_idx = np.array([(ins_a.index, ins_b.index) for ins_a, ins_b in alias_list],
+                                  dtype=np.int32).reshape((-1, 2))
+
+    def add_dot_chain(self, lhs, weights):
+        """Append a chain of dots lhs x weights[0] x weights[1] x ... with the
+           default contracting dims and return the outputs of all dots.
+           This is only a convenience loop; HloDot checks the shapes."""
+        assert HloComputation.cur_env is self
+        outputs = []
+        for w in weights:
+            lhs = HloDot(lhs, w)
+            outputs.append(lhs)
+        return outputs
 
     def concurrency_analysis(self):
         frontier_list = []
@@ -1066,9 +1188,22 @@ class HloComputation:
             for i in range(len(self.instructions)):
                 print(f"Time {i:2d}: {self.instructions[i]}  Batch: {self.instructions[i].batch_dim}")
 
-        # Build strategies and costs for each instruction
+        # Build strategies and costs for each instruction.
+        # Identical dots (e.g., in repeated layers) share one strategy table.
+        dot_strategy_tables = {}
         for ins in self.instructions:
-            ins.build_strategy_and_cost(cluster_env, solver_option)
+            if ins.op_code != OpCode.DOT:
+                ins.build_strategy_and_cost(cluster_env, solver_option)
+                continue
+
+            key = ins.strategy_key()
+            if key in dot_strategy_tables:
+                (ins.strategies, ins.compute_costs, ins.communication_costs,
+                 ins.memory_costs, ins.resharding_costs) = dot_strategy_tables[key]
+            else:
+                ins.build_strategy_and_cost(cluster_env, solver_option)
+                dot_strategy_tables[key] = (ins.strategies, ins.compute_costs,
+                    ins.communication_costs, ins.memory_costs, ins.resharding_costs)
 
         # Build alias costs
         for (ins_a, ins_b) in self.alias_list:
@@ -1084,12 +1219,36 @@ class HloComputation:
 
         self.strategy_built = True
 
+    # Shortcuts to create instructions in this computation, e.g.,
+    #   with HloComputation() as b:
+    #       y = b.dot(b.param((4, 4)), b.param((4, 4)))
+    # They can only be called inside the `with` block of the computation.
+    param = _builder(HloParameter)
+    const = _builder(HloConstant)
+    broadcast = _builder(HloBroadcast)
+    reshape = _builder(HloReshape)
+    transpose = _builder(HloTranspose)
+    identity = _builder(HloIdentity)
+    exp = _builder(HloExp)
+    force_replicated = _builder(HloForceReplicated)
+    add = _builder(HloAdd)
+    sub = _builder(HloSubtract)
+    mul = _builder(HloMutiply)
+    div = _builder(HloDiv)
+    compare = _builder(HloCompare)
+    select = _builder(HloSelect)
+    reduce = _builder(HloReduce)
+    dot = _builder(HloDot)
+    tuple_ = _builder(HloTuple)
+
     def __enter__(self):
         assert HloComputation.cur_env is None
         HloComputation.cur_env = self
+        return self
 
     def __exit__(self, *args, **kwargs):
         HloComputation.cur_env = None
+        self.freeze()
 
     def __str__(self):
         strs = []
@@ -1,26 +1,218 @@
 """ILP Solver"""
+from collections import OrderedDict
+
 import numpy as np
 
-from alpa.shard_parallel.auto_sharding import _call_solver_serialized_args
+from common import compute_bytes
+from hlo import OpCode
+
+
+# A LRU cache that maps a serialized ILP to its solution, so solving the same graph
+# on the same cluster environment again does not call the ILP solver.
+solver_cache = OrderedDict()
+SOLVER_CACHE_SIZE = 64
+
+
+def call_highs_solver_serialized_args(N, M, s_len_np, s_follow_np, E_np, A_np, L_np,
+                                      c_np, d_np, m_np, r_np, v_np, s_init_np=None):
+    """Build the same ILP as alpa's _call_solver_serialized_args and solve it with
+       the in-process HiGHS solver. The arguments and return values are the same."""
+    import highspy
+
+    def split(array, lengths):
+        if len(lengths) == 0:
+            return []
+        return np.split(array, np.cumsum(lengths)[:-1])
+
+    # 0. Unpack flatten numpy arrays
+    s_len = s_len_np
+    s_follow = s_follow_np
+    E = E_np.reshape((-1, 2))
+    A = A_np.reshape((-1, 2))
+    r = split(r_np, [s_len[i] * s_len[j] for (i, j) in E])
+    v = split(v_np, [s_len[i] * s_len[j] for (i, j) in A])
+    L = split(L_np[N:], L_np[:N])
+    c = split(c_np, s_len)
+    d = split(d_np, s_len)
+    m = split(m_np, s_len)
+    assert len(set(map(tuple, E.tolist()))) == len(E), "Duplicated edges"
+
+    # 1. Create variables
+    # Every strategy vector is an array of column indices, where -1 is the constant 1.
+    one = np.array([-1], dtype=np.int32)
+    num_cols = 0
+
+    def new_cols(n):
+        nonlocal num_cols
+        num_cols += n
+        return np.arange(num_cols - n, num_cols, dtype=np.int32)
+
+    s = [None] * N
+    for i in range(N):
+        if s_follow[i] < 0:
+            s[i] = one if s_len[i] == 1 else new_cols(s_len[i])
+    for i in range(N):
+        if s_follow[i] >= 0:
+            s[i] = s[s_follow[i]]
+
+    e = []
+    for (idx, (i, j)) in enumerate(E):
+        if len(s[i]) == 1:
+            e.append(s[j])
+        elif len(s[j]) == 1:
+            e.append(s[i])
+        else:
+            e.append(new_cols(len(s[i]) * len(s[j])))
+        assert len(e[idx]) == len(r[idx])
+
+    # 2. Objective
+    obj = np.zeros((num_cols,))
+    obj_offset = 0.0
+
+    def add_objective(cols, coefs):
+        nonlocal obj_offset
+        mask = cols >= 0
+        np.add.at(obj, cols[mask], coefs[mask])
+        obj_offset += coefs[~mask].sum()
+
+    for i in range(N):
+        add_objective(s[i], c[i].astype(np.float64) + d[i])
+    for idx in range(len(E)):
+        add_objective(e[idx], r[idx].astype(np.float64))
+
+    # 3. Constraints
+    rows = []
+
+    def add_row(cols, coefs, lower, upper):
+        cols = np.asarray(cols)
+        coefs = np.asarray(coefs, dtype=np.float64)
+        mask = cols >= 0
+        const = coefs[~mask].sum()
+        cols, inverse = np.unique(cols[mask], return_inverse=True)
+        coefs = np.bincount(inverse, weights=coefs[mask], minlength=len(cols))
+        rows.append((cols, coefs, lower - const, upper - const))
+
+    # (b)
+    for i in range(N):
+        if s_follow[i] < 0 and s_len[i] > 1:
+            add_row(s[i], np.ones(len(s[i])), 1, 1)
+
+    # (c)
+    if M > 0:
+        for t in range(N):
+            if len(L[t]):
+                add_row(np.concatenate([s[i] for i in L[t]]),
+                        np.concatenate([m[i] for i in L[t]]), -np.inf, M)
+
+    for (idx, (i, j)) in enumerate(E):
+        if s_len[i] == 1 or s_len[j] == 1:
+            continue
+        R, C = len(s[i]), len(s[j])
+        e_mat = e[idx].reshape((R, C))
+
+        # (e)
+        add_row(e[idx], np.ones(R * C), 1, 1)
+
+        # (f)
+        for row in range(R):
+            add_row(np.append(e_mat[row], s[i][row]), [1] * C + [-1], -np.inf, 0)
+
+        # (g)
+        for col in range(C):
+            add_row(np.append(e_mat[:, col], s[j][col]), [1] * R + [-1], -np.inf, 0)
+
+    # (h)
+    alias_set = set()
+    for (idx, (i, j)) in enumerate(A):
+        if (i, j) in alias_set:
+            raise ValueError(f"Duplicated edges: {(i, j)}")
+        alias_set.add((i, j))
+        alias_set.add((j, i))
+
+        C = len(s[j])
+        for row in range(len(s[i])):
+            for col in range(len(s[j])):
+                if v[idx][row * C + col] > 0.5:
+                    add_row([s[i][row], s[j][col]], [1, 1], -np.inf, 1)
+
+    # 4. Pass the model to HiGHS
+    h = highspy.Highs()
+    h.setOptionValue("output_flag", False)
+    h.setOptionValue("time_limit", 600.0)
+
+    empty_int = np.empty((0,), dtype=np.int32)
+    col_indices = np.arange(num_cols, dtype=np.int32)
+    h.addCols(num_cols, obj, np.zeros(num_cols), np.ones(num_cols),
+              0, empty_int, empty_int, np.empty((0,)))
+    h.changeColsIntegrality(num_cols, col_indices,
+                            np.full((num_cols,), highspy.HighsVarType.kInteger.value,
+                                    dtype=np.uint8))
+
+    row_lens = [len(cols) for cols, _, _, _ in rows]
+    row_starts = np.concatenate([[0], np.cumsum(row_lens)[:-1]]).astype(np.int32)
+    h.addRows(len(rows),
+              np.array([lower for _, _, lower, _ in rows], dtype=np.float64),
+              np.array([upper for _, _, _, upper in rows], dtype=np.float64),
+              int(sum(row_lens)), row_starts,
+              np.concatenate([empty_int] + [cols for cols, _, _, _ in rows]).astype(np.int32),
+              np.concatenate([np.empty((0,))] + [coefs for _, coefs, _, _ in rows]))
+
+    # 5. Set initial value for warm start
+    if s_init_np is not None and len(s_init_np):
+        init_cols, init_values = [], []
+        for (idx, value, fix) in s_init_np.reshape((-1, 3)):
+            indicator = (np.arange(len(s[idx])) == value).astype(np.float64)
+            init_cols.append(s[idx])
+            init_values.append(indicator)
+            if fix:
+                h.changeColsBounds(len(s[idx]), s[idx], indicator, indicator)
+        init_cols = np.concatenate(init_cols)
+        h.setSolution(len(init_cols), init_cols, np.concatenate(init_values))
+
+    # 6. Solve
+    if num_cols > 0:
+        h.run()
+        status = h.getModelStatus()
+        if status == highspy.HighsModelStatus.kInfeasible:
+            raise RuntimeError(
+                "Cannot run the function under the given memory budget. "
+                "Please increase the memory budget.")
+        col_value = np.array(h.getSolution().col_value)
+        objective = h.getInfo().objective_function_value + obj_offset
+    else:
+        status = highspy.HighsModelStatus.kOptimal
+        col_value = np.empty((0,))
+        objective = obj_offset
+
+    # Get and check results
+    def get_non_zero_index(cols):
+        if cols[0] < 0:
+            return 0
+        selected = np.nonzero(col_value[cols] > 0.5)[0]
+        assert len(selected) == 1
+        return selected[0]
+
+    s_val = np.array([get_non_zero_index(s[i]) for i in range(N)], dtype=np.int32)
+    e_val = np.full((len(E),), -1, dtype=np.int32)
+    for (idx, (i, j)) in enumerate(E):
+        e_val[idx] = get_non_zero_index(e[idx])
+        assert e_val[idx] // len(s[j]) == s_val[i], f"e_val[{i}][{j}]"
+        assert e_val[idx] % len(s[j]) == s_val[j], f"e_val[{i}][{j}]"
+
+    return s_val, e_val, float(objective), status
 
 
-def call_solver(N, M, s_len, s_follow, E, A, L, c, d, m, r, v, s_init):
+def call_solver(N, M, s_len, s_follow, E, A, L, c, d, m, r, v, s_init, backend="highs"):
     """Serialize python lists to flatten numpy arraies and call solver"""
     # Serialize strategy lengths
     s_len_np = np.array(s_len, dtype=np.int32)
     s_follow_np = np.array(s_follow, dtype=np.int32)
 
     # Serialize edge set
-    len_edges = len(E)
-    E_np = np.empty((len_edges, 2), dtype=np.int32)
-    for (idx, (i, j)) in enumerate(E):
-        E_np[idx][:] = [i, j]
+    E_np = np.array(E, dtype=np.int32).reshape((-1, 2))
 
     # Serialize alias set
-    len_aliases = len(A)
-    A_np = np.empty((len_aliases, 2), dtype=np.int32)
-    for (idx, (i, j)) in enumerate(A):
-        A_np[idx][:] = [i, j]
+    A_np = np.array(A, dtype=np.int32).reshape((-1, 2))
 
     # Serialize liveness set
     len_liveness_set = N + sum(len(v) for v in L)
@@ -47,12 +239,35 @@ def call_solver(N, M, s_len, s_follow, E, A, L, c, d, m, r, v, s_init):
     v_np = np.empty((len_alias_costs,), dtype=np.float32)
     v_np[:] = [x for vec in v for x in vec]
 
-    # Serialize init value
-    s_init_np = None
-
-    return _call_solver_serialized_args(
+    # Serialize init value as (node index, strategy index, fix) triples
+    if s_init is None:
+        s_init_np = None
+    else:
+        s_init_np = np.array([(i, s_init[i], 0) for i in range(N)
+                              if s_follow[i] < 0 and 0 <= s_init[i] < s_len[i] and s_len[i] > 1],
+                             dtype=np.int32).reshape(-1)
+
+    if backend == "highs":
+        solver_func = call_highs_solver_serialized_args
+    elif backend == "pulp":
+        from alpa.shard_parallel.auto_sharding import _call_solver_serialized_args
+        solver_func = _call_solver_serialized_args
+    else:
+        raise ValueError(f"Invalid solver backend: {backend}")
+
+    key = (backend, N, M) + tuple(x.tobytes() for x in
+        (s_len_np, s_follow_np, E_np, A_np, L_np, c_np, d_np, m_np, r_np, v_np))
+    if key in solver_cache:
+        solver_cache.move_to_end(key)
+        return solver_cache[key]
+
+    ret = solver_func(
         N, M, s_len_np, s_follow_np, E_np, A_np, L_np,
         c_np, d_np, m_np, r_np, v_np, s_init_np)
+    solver_cache[key] = ret
+    while len(solver_cache) > SOLVER_CACHE_SIZE:
+        solver_cache.popitem(last=False)
+    return ret
 
 
 class CostGraph:
@@ -131,16 +346,14 @@ class CostGraph:
         self.reindexing_vector[src] = reindexing
 
         # Merge edge cost matrix
+        # added_edge_cost[i][k] = edge_cost_src_adj[reindexing[i]][k] + edge_cost[i][reindexing[i]]
+        follow_cost = edge_cost[np.arange(self.node_lens[dst]), reindexing]
         adj_list = list(self.adjacency[src])
         for adj in adj_list:
             if adj == dst:
                 continue
-            added_edge_cost = np.empty((self.node_lens[dst], self.node_lens[adj]))
-            for i in range(self.node_lens[dst]):
-                j = reindexing[i]
-                edge_cost_src_adj = self.get_edge_cost(src, adj)
-                for k in range(self.node_lens[adj]):
-                    added_edge_cost[i][k] = edge_cost_src_adj[j][k] + edge_cost[i][j]
+            edge_cost_src_adj = self.get_edge_cost(src, adj)
+            added_edge_cost = edge_cost_src_adj[reindexing] + follow_cost[:, None]
 
             self.add_edge_cost(dst, adj, added_edge_cost)
 
@@ -217,8 +430,106 @@ class SolverOption:
         self.force_all_gather_cost = None
         self.force_reduce_scatter_cost = None
 
+        self.try_analytical = False
+
+        # The ILP solver backend: "highs" (in-process) or "pulp" (CBC in alpa)
+        self.backend = "highs"
+
+
+# Op codes that can appear in a plain MLP computation
+MLP_CHAIN_OP_CODES = {
+    OpCode.PARAMETER, OpCode.CONSTANT, OpCode.BROADCAST, OpCode.EXP,
+    OpCode.SUBTRACT, OpCode.MULTIPLY, OpCode.DOT, OpCode.TUPLE,
+}
+
+
+def solve_auto_sharding_mlp_chain(computation, cluster_env):
+    """Compute the objective of a plain MLP directly from the cost formulas.
+
+    This only handles a chain of forward dots with identical square weights
+    on a mesh with one non-trivial dimension, where the optimal plan is either
+    data parallel (all-reduce on every weight) or Megatron-style model parallel
+    (all-reduce on all but one activation). Return None if the computation
+    does not match, so the caller can fall back to the ILP.
+    """
+    mesh_dims = [i for i, x in enumerate(cluster_env.device_mesh.shape) if x > 1]
+    if len(mesh_dims) != 1:
+        return None
+    mesh_dim = mesh_dims[0]
+
+    if (cluster_env.force_all_gather_cost or cluster_env.force_all_reduce_cost or
+        cluster_env.force_reduce_scatter_cost):
+        return None
+
+    # Make sure the memory constraint can never be active
+    M = cluster_env.memory_per_device
+    if M is not None and M > 0 and computation.byte_sizes.sum() > M:
+        return None
+
+    # Match the chain of forward dots
+    chain = []
+    for ins in computation.instructions:
+        if ins.op_code not in MLP_CHAIN_OP_CODES:
+            return None
+        if (ins.op_code == OpCode.DOT and ins.lhs_contracting_dims == (1,) and
+            ins.rhs_contracting_dims == (0,)):
+            if ins.rhs.op_code != OpCode.PARAMETER:
+                return None
+            if chain and ins.lhs is not chain[-1]:
+                return None
+            if not chain and ins.lhs.op_code != OpCode.PARAMETER:
+                return None
+            chain.append(ins)
+
+    if not chain:
+        return None
+    weight_shape = chain[0].rhs.shape
+    if weight_shape[0] != weight_shape[1]:
+        return None
+    for ins in chain:
+        if ins.rhs.shape != weight_shape or ins.shape != chain[0].lhs.shape:
+            return None
+
+    # Every weight must be updated in place by a weight gradient, otherwise
+    # (e.g., a forward-only chain) the closed form does not hold.
+    alias_dict = {ins_a: ins_b for ins_a, ins_b in computation.alias_list}
+    for ins in chain:
+        new_w = alias_dict.get(ins.rhs)
+        if (new_w is None or new_w.op_code != OpCode.SUBTRACT or
+            new_w.operands[0] is not ins.rhs):
+            return None
+        grad_w = new_w.operands[1]
+        if grad_w.op_code != OpCode.DOT or grad_w.shape != ins.rhs.shape:
+            return None
+
+    num_layers = len(chain)
+    data_parallel_cost = num_layers *\
+        cluster_env.all_reduce_cost(compute_bytes(weight_shape), mesh_dim)
+    model_parallel_cost = (num_layers - 1) *\
+        cluster_env.all_reduce_cost(compute_bytes(chain[0].shape), mesh_dim)
+    return min(data_parallel_cost, model_parallel_cost)
+
+
+def solve_auto_sharding(computation, cluster_env, solver_option=None, warm_start=None,
+                        return_solution=False):
+    """Solve the auto-sharding ILP and return its objective.
+
+    `warm_start` is a strategy vector from an earlier solve of a graph with the same
+    instructions (e.g. the one returned with `return_solution=True`). It is only used
+    as an initial solution by the "highs" backend. alpa's pulp backend runs CBC
+    without warmStart, so it ignores the hint.
+    If `return_solution` is True, return (objective, strategy vector) instead.
+    The strategy vector is None if the analytical fast path is taken.
+    """
+    if solver_option is None:
+        solver_option = SolverOption()
+
+    if (solver_option.try_analytical and
+        solver_option.force_batch_dim_to_mesh_dim is None):
+        objective = solve_auto_sharding_mlp_chain(computation, cluster_env)
+        if objective is not None:
+            return (objective, None) if return_solution else objective
 
-def solve_auto_sharding(computation, cluster_env, solver_option=None):
     print("===== Hlo Computation =====")
     print(computation, "\n")
 
@@ -229,19 +540,20 @@ def solve_auto_sharding(computation, cluster_env, solver_option=None):
         names.sort()
         print(f"Time: {i}, Live set: {names}")
 
-    if solver_option is None:
-        solver_option = SolverOption()
-
     # Build strategies and costs
     computation.build_strategy_and_cost(cluster_env, solver_option)
 
     # Build all constants for ILP
     N = len(computation.instructions)
     M = cluster_env.memory_per_device
+    operand_indptr = computation.operand_indptr
+
+    # All (operand, instruction) edges, in the order of instructions and operands
+    edge_dst = np.repeat(np.arange(N, dtype=np.int32), np.diff(operand_indptr))
+    E = np.stack([computation.operand_indices, edge_dst], axis=1).tolist()
 
     s_len = []
     follow_pair = []
-    E = []
     A = []
     L = []
     c = []
@@ -260,18 +572,14 @@ def solve_auto_sharding(computation, cluster_env, solver_option=None):
         if ins.follow_ins is not None:
             follow_pair.append((ins.index, ins.follow_ins.index))
 
-        for op_idx, operand in enumerate(ins.operands):
-            E.append((operand.index, i))
-
-            src = operand.index
-            dst = i
-
+        for op_idx, (src, dst) in enumerate(
+                E[operand_indptr[i]:operand_indptr[i + 1]]):
             #ins.resharding_costs  # [s_i, operand_idx, s_operand]
-            cost = []
-            for p in range(len(computation.instructions[src].strategies)):
-                for q in range(len(computation.instructions[dst].strategies)):
-                    cost.append(ins.resharding_costs[q][op_idx][p])
-            r.append(cost)
+            # Transpose it to a flatten [s_operand, s_i] matrix
+            cost = np.array([x[op_idx] for x in ins.resharding_costs], dtype=np.float64)
+            cost = cost.reshape((len(ins.strategies),
+                                 len(computation.instructions[src].strategies)))
+            r.append(cost.T.reshape(-1))
 
     # Simplify the graph by merging nodes
     cost_graph = CostGraph(s_len, E, r, follow_pair)
@@ -286,10 +594,10 @@ def solve_auto_sharding(computation, cluster_env, solver_option=None):
             m[src] = np.array(m[src])[reindexing_vector[src]]
 
     # Deal with alias
-    for ((ins_a, ins_b), cost_vector) in zip(computation.alias_list,
+    for ((idx_a, idx_b), cost_vector) in zip(computation.alias_idx.tolist(),
                                              computation.alias_cost_vector):
 
-        idx_a, idx_b = ins_a.index, ins_b.index
+        ins_a, ins_b = computation.instructions[idx_a], computation.instructions[idx_b]
         cost_vector = np.array(cost_vector).reshape(
             len(ins_a.strategies), len(ins_b.strategies))
 
@@ -313,8 +621,12 @@ def solve_auto_sharding(computation, cluster_env, solver_option=None):
                     new_cost_vector.append(cost_vector[i, j])
             v.append(new_cost_vector)
 
+    if warm_start is not None and len(warm_start) != N:
+        warm_start = None
+
     s_val, e_val, objective, status = call_solver(N, M, s_len, s_follow, E, A, L,
-                                                  c, d, m, r, v, s_init=None)
+                                                  c, d, m, r, v, s_init=warm_start,
+                                                  backend=solver_option.backend)
 
     if True:
         # Print sharding spec
@@ -355,4 +667,4 @@ def solve_auto_sharding(computation, cluster_env, solver_option=None):
                 mem += m[i][s_val[i]]
             print(f"Time {t}, memory: {mem / 1024**2: .2f} MB")
 
-    return objective
+    return (objective, s_val) if return_solution else objective
@@ -140,10 +140,26 @@ def test_resharding_cost2():
     assert_allclose(cost, 0)
 
 
+def test_collective_cost():
+    # A non-power-of-two mesh, where (p - 1) / p is not exact in floating point
+    cluster_env = ClusterEnvironment([[0], [1], [2]], [0, 0], [0.01, 0.01], None)
+
+    assert cluster_env.all_gather_cost(150, 0) == 1.1
+    assert cluster_env.all_reduce_cost(150, 0) == 2.01
+    assert cluster_env.reduce_scatter_cost(150, 0) == 1.001
+
+    cluster_env = ClusterEnvironment([[0, 1, 2, 3, 4]], [1, 1], [0.3, 0.3], None)
+
+    assert cluster_env.all_gather_cost(777, 1) == 187.1
+    assert cluster_env.all_reduce_cost(777, 1) == 373.01
+    assert cluster_env.reduce_scatter_cost(777, 1) == 187.001
+
+
 if __name__ == "__main__":
     test_tile()
     test_tile2()
     #test_tile3()
     test_resharding_cost()
     test_resharding_cost2()
+    test_collective_cost()
 
@@ -14,8 +14,8 @@ from solver import solve_auto_sharding, SolverOption
 
 MB = 1024 ** 2
 
-def assert_close(x, y):
-    assert abs(x / y - 1) < 0.001, f"{x} vs. {y}"
+def assert_close(x, y, rtol=1e-3):
+    assert abs(x - y) <= rtol * abs(y), f"{x} vs. {y}"
 
 
 def solve_without_all_gather(computation, mesh_shape):
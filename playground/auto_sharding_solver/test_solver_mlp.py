@@ -3,76 +3,76 @@ Usage:
 python3 -m unittest -bv test_solver_mlp.py
 """
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 import unittest
+from unittest import mock
 
 import numpy as np
 
 from hlo import *
 from cluster_env import ClusterEnvironment
-from solver import solve_auto_sharding, SolverOption
+import solver
+from solver import solve_auto_sharding, solve_auto_sharding_mlp_chain, SolverOption
 
 MB = 1024 ** 2
 
 
-def assert_close(x, y):
-    assert abs(x / y - 1) < 0.001, f"{x} vs. {y}"
+def assert_close(x, y, rtol=1e-3):
+    assert abs(x - y) <= rtol * abs(y), f"{x} vs. {y}"
 
 
 def get_mlp_2_layer_computation(batch_size, input_dim, hidden_dim, output_dim):
-    computation = HloComputation()
-    with computation:
-        x = HloParameter((batch_size, input_dim))
-        y = HloParameter((batch_size, output_dim))
-        w1 = HloParameter((input_dim, hidden_dim))
-        w2 = HloParameter((hidden_dim, output_dim))
+    with HloComputation() as b:
+        x = b.param((batch_size, input_dim))
+        y = b.param((batch_size, output_dim))
+        w1 = b.param((input_dim, hidden_dim))
+        w2 = b.param((hidden_dim, output_dim))
 
         ## forward
-        h1 = HloDot(x, w1)
-        h2 = HloDot(h1, w2)
-        loss = HloSubtract(h2, y)
+        h1 = b.dot(x, w1)
+        h2 = b.dot(h1, w2)
+        loss = b.sub(h2, y)
 
         ## backward
-        coef = HloConstant(2 / batch_size / output_dim)
-        coef = HloBroadcast(coef, (batch_size, output_dim))
-        grad_loss = HloMutiply(loss, coef)
-
-        grad_w2 = HloDot(h1, grad_loss,
-                         lhs_contracting_dims=(0,),
-                         rhs_contracting_dims=(0,),)
-        new_w2 = HloSubtract(w2, grad_w2)
-        grad_h1 = HloDot(grad_loss, w2,
-                         lhs_contracting_dims=(1,),
-                         rhs_contracting_dims=(1,),)
-
-        grad_w1 = HloDot(x, grad_h1,
-                         lhs_contracting_dims=(0,),
-                         rhs_contracting_dims=(0,),)
-        new_w1 = HloSubtract(w1, grad_w1)
-        out = HloTuple((new_w1, new_w2))
+        coef = b.const(2 / batch_size / output_dim)
+        coef = b.broadcast(coef, (batch_size, output_dim))
+        grad_loss = b.mul(loss, coef)
+
+        grad_w2 = b.dot(h1, grad_loss,
+                        lhs_contracting_dims=(0,),
+                        rhs_contracting_dims=(0,),)
+        new_w2 = b.sub(w2, grad_w2)
+        grad_h1 = b.dot(grad_loss, w2,
+                        lhs_contracting_dims=(1,),
+                        rhs_contracting_dims=(1,),)
+
+        grad_w1 = b.dot(x, grad_h1,
+                        lhs_contracting_dims=(0,),
+                        rhs_contracting_dims=(0,),)
+        new_w1 = b.sub(w1, grad_w1)
+        out = b.tuple_((new_w1, new_w2))
 
         ## alias
-        computation.set_alias([(w1, new_w1), (w2, new_w2)])
-
-        """
-         0: parameter.0 (128, 1024) = parameter()
-         1: parameter.1 (128, 1024) = parameter()
-         2: parameter.2 (1024, 1024) = parameter()
-         3: parameter.3 (1024, 1024) = parameter()
-         4: dot.0 (128, 1024) = dot(parameter.0, parameter.2)  lhs_con_dim=(1,), rhs_con_dim=(0,)
-         5: dot.1 (128, 1024) = dot(dot.0, parameter.3)  lhs_con_dim=(1,), rhs_con_dim=(0,)
-         6: subtract.0 (128, 1024) = subtract(dot.1, parameter.1)
-         7: constant.0 () = constant(1.52587891e-05)
-         8: broadcast.0 (128, 1024) = broadcast(constant.0)
-         9: multiply.0 (128, 1024) = multiply(subtract.0, broadcast.0)
-        10: dot.2 (1024, 1024) = dot(dot.0, multiply.0)  lhs_con_dim=(0,), rhs_con_dim=(0,)
-        11: subtract.1 (1024, 1024) = subtract(parameter.2, dot.2)
-        12: dot.3 (128, 1024) = dot(multiply.0, parameter.3)  lhs_con_dim=(1,), rhs_con_dim=(1,)
-        13: dot.4 (1024, 1024) = dot(parameter.0, dot.3)  lhs_con_dim=(0,), rhs_con_dim=(0,)
-        14: subtract.2 (1024, 1024) = subtract(parameter.2, dot.4)
-        15: tuple.0 () = tuple('subtract.2', 'subtract.1') 
-        """
-    return computation
+        b.set_alias([(w1, new_w1), (w2, new_w2)])
+
+        #  0: parameter.0 (128, 1024) = parameter()
+        #  1: parameter.1 (128, 1024) = parameter()
+        #  2: parameter.2 (1024, 1024) = parameter()
+        #  3: parameter.3 (1024, 1024) = parameter()
+        #  4: dot.0 (128, 1024) = dot(parameter.0, parameter.2)  lhs_con_dim=(1,), rhs_con_dim=(0,)
+        #  5: dot.1 (128, 1024) = dot(dot.0, parameter.3)  lhs_con_dim=(1,), rhs_con_dim=(0,)
+        #  6: subtract.0 (128, 1024) = subtract(dot.1, parameter.1)
+        #  7: constant.0 () = constant(1.52587891e-05)
+        #  8: broadcast.0 (128, 1024) = broadcast(constant.0)
+        #  9: multiply.0 (128, 1024) = multiply(subtract.0, broadcast.0)
+        # 10: dot.2 (1024, 1024) = dot(dot.0, multiply.0)  lhs_con_dim=(0,), rhs_con_dim=(0,)
+        # 11: subtract.1 (1024, 1024) = subtract(parameter.2, dot.2)
+        # 12: dot.3 (128, 1024) = dot(multiply.0, parameter.3)  lhs_con_dim=(1,), rhs_con_dim=(1,)
+        # 13: dot.4 (1024, 1024) = dot(parameter.0, dot.3)  lhs_con_dim=(0,), rhs_con_dim=(0,)
+        # 14: subtract.2 (1024, 1024) = subtract(parameter.2, dot.4)
+        # 15: tuple.0 () = tuple('subtract.2', 'subtract.1')
+    return b
 
 
 def get_mlp_2_layer_bias_computation(batch_size, input_dim, hidden_dim, output_dim):
@@ -142,13 +142,8 @@ def get_mlp_n_layer_computation(num_layers, batch_size, input_dim, hidden_dim, o
         w_last = HloParameter((hidden_dim, output_dim))
 
         # forward
-        h_first = HloDot(x, w_first)
-        h_now = h_first
-        h_inter = []
-        for i in range(num_layers - 2):
-            h_now = HloDot(h_now, w_inter[i])
-            h_inter.append(h_now)
-        h_last = HloDot(h_now, w_last)
+        h_first, *h_inter, h_last = computation.add_dot_chain(
+            x, [w_first] + w_inter + [w_last])
 
         loss = HloSubtract(h_last, y)
 
@@ -191,7 +186,43 @@ def get_mlp_n_layer_computation(num_layers, batch_size, input_dim, hidden_dim, o
     return computation
 
 
+def get_mlp_n_layer_forward_computation(num_layers, batch_size, hidden_dim):
+    computation = HloComputation()
+    with computation:
+        x = HloParameter((batch_size, hidden_dim))
+        y = HloParameter((batch_size, hidden_dim))
+        w = [HloParameter((hidden_dim, hidden_dim)) for i in range(num_layers)]
+
+        h = computation.add_dot_chain(x, w)
+        loss = HloSubtract(h[-1], y)
+        out = HloTuple((loss,))
+    return computation
+
+
 class MLPSolverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._env_cache = {}
+
+    def get_cluster_env(self, mesh_shape, mesh_alpha, mesh_beta, memory_per_device,
+                        solver_option=None):
+        """Get a cluster environment shared by all tests in this class"""
+        # The environment only reads the forced costs from solver_option
+        forced_costs = None
+        if solver_option:
+            forced_costs = (solver_option.force_all_gather_cost,
+                            solver_option.force_all_reduce_cost,
+                            solver_option.force_reduce_scatter_cost)
+        key = (tuple(mesh_shape), tuple(mesh_alpha), tuple(mesh_beta),
+               memory_per_device, forced_costs)
+
+        if key not in self._env_cache:
+            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
+            self._env_cache[key] = ClusterEnvironment(device_mesh, mesh_alpha, mesh_beta,
+                                                      memory_per_device=memory_per_device,
+                                                      solver_option=solver_option)
+        return self._env_cache[key]
+
     def test_mlp_2_layer_data_parallel(self):
         # Build Hlo Computation
         batch_size = 1024
@@ -202,9 +233,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([ (4, 1), (1, 4) ]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             # The expecte cost is always two all-reduce on weights
@@ -221,9 +250,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([ (4, 1), (1, 4) ]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             # The expecte cost is always one all-reduce on activations
@@ -241,9 +268,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([ (4, 1), (1, 4) ]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = num_layers *\
@@ -261,9 +286,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([ (4, 1), (1, 4) ]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = (num_layers - 1) *\
@@ -280,9 +303,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for mesh_shape in [(4, 8), (8, 4), (3, 4)]:
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 0.01],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 0.01], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected =\
@@ -301,9 +322,7 @@ class MLPSolverTest(unittest.TestCase):
             hidden_dim, hidden_dim)
 
         for mesh_shape in [(4, 8), (8, 4), (3, 4)]:
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 0.01],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 0.01], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = \
@@ -323,9 +342,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([(4, 1), (1, 4)]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = \
@@ -343,9 +360,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for i, mesh_shape in enumerate([(4, 1), (1, 4)]):
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = cluster_env.all_reduce_cost(batch_size * hidden_dim * 4, i)
@@ -361,9 +376,7 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         for mesh_shape in [(4, 8), (8, 4), (3, 4)]:
-            device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
-            cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 0.01],
-                                             memory_per_device=1000 * MB)
+            cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 0.01], 1000 * MB)
             objective = solve_auto_sharding(computation, cluster_env)
 
             expected = \
@@ -384,19 +397,99 @@ class MLPSolverTest(unittest.TestCase):
 
         # Test different device meshes
         mesh_shape = [4, 1]
-        device_mesh = np.arange(np.prod(mesh_shape)).reshape(mesh_shape)
         solver_option = SolverOption()
         solver_option.force_batch_dim_to_mesh_dim = 0
         solver_option.force_all_gather_cost = 1e10
-        cluster_env = ClusterEnvironment(device_mesh, [1, 1], [1, 1],
-                                         memory_per_device=1000 * MB,
-                                         solver_option=solver_option)
+        cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB,
+                                           solver_option)
         objective = solve_auto_sharding(computation, cluster_env, solver_option)
 
         # The expecte cost is always one all-reduce on activations
         expected = 2 * cluster_env.all_reduce_cost(hidden_dim * hidden_dim * 4, 0)
         assert_close(objective, expected)
 
+    def test_mlp_2_layer_warm_start(self):
+        # Build Hlo Computation
+        batch_size = 128
+        hidden_dim = 1024
+
+        computation = get_mlp_2_layer_computation(batch_size, hidden_dim,
+            hidden_dim, hidden_dim)
+
+        mesh_shape = [4, 1]
+        cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
+        _, warm_start = solve_auto_sharding(computation, cluster_env,
+                                            return_solution=True)
+
+        # Re-solve a perturbed problem starting from the last solution
+        solver_option = SolverOption()
+        solver_option.force_all_gather_cost = 1e10
+        cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB,
+                                           solver_option)
+        solver.solver_cache.clear()
+        with mock.patch.object(solver, "call_highs_solver_serialized_args",
+                               wraps=solver.call_highs_solver_serialized_args) as func:
+            objective = solve_auto_sharding(computation, cluster_env, solver_option,
+                                            warm_start=warm_start)
+
+        # The last solution is passed to the solver as the initial value
+        s_init_np = func.call_args.args[-1].reshape((-1, 3))
+        assert len(s_init_np) > 0
+        for (idx, value, fix) in s_init_np:
+            assert value == warm_start[idx] and fix == 0
+
+        expected = cluster_env.all_reduce_cost(batch_size * hidden_dim * 4, 0)
+        assert_close(objective, expected)
+
+    def test_solver_cache(self):
+        computation = get_mlp_2_layer_computation(128, 1024, 1024, 1024)
+        cluster_env = self.get_cluster_env((4, 1), [1, 1], [1, 1], 1000 * MB)
+        other_cluster_env = self.get_cluster_env((1, 4), [1, 1], [1, 1], 1000 * MB)
+
+        solver.solver_cache.clear()
+        with mock.patch.object(solver, "call_highs_solver_serialized_args",
+                               wraps=solver.call_highs_solver_serialized_args) as func:
+            objective = solve_auto_sharding(computation, cluster_env)
+            assert solve_auto_sharding(computation, cluster_env) == objective
+            assert func.call_count == 1
+
+            # The cache is bounded
+            with mock.patch.object(solver, "SOLVER_CACHE_SIZE", 1):
+                solve_auto_sharding(computation, other_cluster_env)
+                assert func.call_count == 2
+                assert len(solver.solver_cache) == 1
+                solve_auto_sharding(computation, cluster_env)
+                assert func.call_count == 3
+
+    def test_mlp_analytical(self):
+        solver_option = SolverOption()
+        solver_option.try_analytical = True
+
+        for batch_size, hidden_dim in [(1024, 128), (128, 1024)]:
+            computations = [
+                get_mlp_2_layer_computation(batch_size, hidden_dim,
+                    hidden_dim, hidden_dim),
+                get_mlp_n_layer_computation(12, batch_size, hidden_dim,
+                    hidden_dim, hidden_dim),
+            ]
+
+            for computation in computations:
+                for i, mesh_shape in enumerate([(4, 1), (1, 4)]):
+                    cluster_env = self.get_cluster_env(mesh_shape, [1, 1], [1, 1], 1000 * MB)
+                    objective = solve_auto_sharding(computation, cluster_env,
+                                                    solver_option)
+                    expected = solve_auto_sharding(computation, cluster_env)
+                    assert_close(objective, expected)
+
+        # The fast path does not apply to a forward-only chain
+        for num_layers in [2, 3]:
+            computation = get_mlp_n_layer_forward_computation(num_layers, 1024, 128)
+            cluster_env = self.get_cluster_env((4, 1), [1, 1], [1, 1], 1000 * MB)
+            assert solve_auto_sharding_mlp_chain(computation, cluster_env) is None
+            objective = solve_auto_sharding(computation, cluster_env, solver_option)
+            expected = solve_auto_sharding(computation, cluster_env)
+            assert_close(objective, expected)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -414,9 +507,40 @@ def suite():
 
     suite.addTest(MLPSolverTest('test_mlp_2_layer_force_data_parallel'))
 
+    suite.addTest(MLPSolverTest('test_mlp_2_layer_warm_start'))
+    suite.addTest(MLPSolverTest('test_solver_cache'))
+    suite.addTest(MLPSolverTest('test_mlp_analytical'))
+
     return suite
 
+
+def _run_one(test_name):
+    result = unittest.TestResult()
+    result.buffer = True
+    # TestCase.run does not run class fixtures
+    MLPSolverTest.setUpClass()
+    MLPSolverTest(test_name).run(result)
+    return [err for _, err in result.errors + result.failures]
+
+
+def run_parallel(max_workers=None):
+    """Run the tests in the suite in separate processes. The tests do not share
+       any state, so they can be solved concurrently."""
+    test_names = [test._testMethodName for test in suite()]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(_run_one, test_names))
+
+    num_failed = 0
+    for test_name, errors in zip(test_names, results):
+        print(f"{test_name} ... {'FAIL' if errors else 'ok'}")
+        for err in errors:
+            print(err)
+        num_failed += bool(errors)
+
+    print(f"Ran {len(test_names)} tests, {num_failed} failed")
+    return num_failed == 0
+
+
 if __name__ == '__main__':
-    runner = unittest.TextTestRunner()
-    runner.run(suite())
+    run_parallel()
 